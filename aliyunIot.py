@@ -32,10 +32,21 @@ from queue import Queue
 from aLiYun import aLiYun
 
 from usr.modules.logging import getLogger
+from usr.modules.common import Waiter
 
 log = getLogger(__name__)
 
-_read_lock = _thread.allocate_lock()
+# Bind json codec functions once, they are called on every message.
+_json_dumps = ujson.dumps
+_json_loads = ujson.loads
+
+# Read only, shared by every report payload.
+_SYS_ACK = {"ack": 1}
+
+# Fixed schema OTA payloads, leaf values are json encoded before filled in.
+_OTA_DEVICE_INFORM_TMPL = '{"id": "%s", "params": {"version": %s, "module": %s}}'
+_OTA_FIRMWARE_GET_TMPL = '{"id": "%s", "version": "1.0", "params": {"module": %s}, "method": "thing.ota.firmware.get"}'
+_OTA_DEVICE_PROGRESS_TMPL = '{"id": "%s", "params": {"step": %s, "desc": %s, "module": %s}}'
 
 FOTA_ERROR_CODE = {
     1001: "FOTA_DOMAIN_NOT_EXIST",
@@ -67,82 +78,131 @@ class AliYunIot:
         self.__qos = qos
         self.__cloud = None
         self.__id_lock = _thread.allocate_lock()
-        self.__get_post_lock = _thread.allocate_lock()
         self.__callback = None
         self.__post_res = {}
+        self.__post_res_deadlines = {}
+        self.__post_res_lock = _thread.allocate_lock()
+        self.__post_res_timer = osTimer()
         self.__conn_tag = 0
-        self.__init_id_iter()
+        self.__id_count = -1
         self.__events = []
         self.__services = []
+        self.__event_topics = {}
+        self.__service_topics = {}
+        self.__reply_topics = {}
 
     @property
     def __timestamp(self):
         return str(utime.mktime(utime.localtime())) + "000"
 
-    def __init_id_iter(self):
-        self.__id_iter = iter(range(0xFFFF))
-
     @property
     def __id(self):
         """Get message id for publishing data"""
         with self.__id_lock:
-            try:
-                _id = next(self.__id_iter)
-            except StopIteration:
-                self.__init_id_iter()
-                _id = next(self.__id_iter)
+            self.__id_count = (self.__id_count + 1) % 0xFFFF
+            _id = self.__id_count
 
         return str(_id)
 
-    def __put_post_res(self, msg_id, res):
-        self.__post_res[msg_id] = res
-
-    def __get_post_res(self, msg_id):
-        with self.__get_post_lock:
-            count = 0
-            while count < int(30 * 1000 / 50):
-                if self.__post_res.get(msg_id) is not None:
-                    break
-                utime.sleep_ms(50)
-                count += 1
-            if count >= 600 and self.__post_res.get(msg_id) is None:
-                self.__post_res[msg_id] = False
-            res = self.__post_res.pop(msg_id)
-            return res
+    def __init_post_res(self, msg_id):
+        """Register a waiter for message reply, must be called before publishing."""
+        waiter = Waiter()
+        self.__post_res[msg_id] = waiter
+        return waiter
+
+    def __put_post_res(self, msg_id, res, waiter=None):
+        """Release the waiter of msg_id with res, if waiter is given, only release when it is still registered."""
+        # Pop waiter under lock first, so reply and timeout can not release it twice.
+        with self.__post_res_lock:
+            _waiter = self.__post_res.get(msg_id)
+            if _waiter is None or (waiter is not None and _waiter is not waiter):
+                return
+            self.__post_res.pop(msg_id)
+        _waiter.info = res
+        _waiter.release()
+
+    def __post_res_timer_callback(self, args):
+        """Shared timeout check for all waiting replies, runs while any reply is waited."""
+        now = utime.ticks_ms()
+        with self.__post_res_lock:
+            expired = [(msg_id, waiter) for msg_id, (deadline, waiter) in self.__post_res_deadlines.items() if utime.ticks_diff(deadline, now) <= 0]
+        for msg_id, waiter in expired:
+            self.__put_post_res(msg_id, False, waiter)
+
+    def __get_post_res(self, msg_id, waiter, timeout=30):
+        with self.__post_res_lock:
+            if not self.__post_res_deadlines:
+                self.__post_res_timer.start(1000, 1, self.__post_res_timer_callback)
+            self.__post_res_deadlines[msg_id] = (utime.ticks_add(utime.ticks_ms(), timeout * 1000), waiter)
+        waiter.acquire()
+        with self.__post_res_lock:
+            self.__post_res_deadlines.pop(msg_id, None)
+            if not self.__post_res_deadlines:
+                self.__post_res_timer.stop()
+        return waiter.info
 
     def __init_topics(self):
+        sys_prefix = "/sys/%s/%s/" % (self.__product_key, self.__device_name)
+        ota_suffix = "/%s/%s" % (self.__product_key, self.__device_name)
         # module object topic
-        self.ica_topic_property_post = "/sys/%s/%s/thing/event/property/post" % (self.__product_key, self.__device_name)
-        self.ica_topic_property_post_reply = "/sys/%s/%s/thing/event/property/post_reply" % (self.__product_key, self.__device_name)
-        self.ica_topic_property_set = "/sys/%s/%s/thing/service/property/set" % (self.__product_key, self.__device_name)
-        self.ica_topic_property_set_reply = "/sys/%s/%s/thing/service/property/set_reply" % (self.__product_key, self.__device_name)
-        self.ica_topic_event_post = "/sys/%s/%s/thing/event/{}/post" % (self.__product_key, self.__device_name)
-        self.ica_topic_event_post_reply = "/sys/%s/%s/thing/event/{}/post_reply" % (self.__product_key, self.__device_name)
-        self.ica_topic_service_sub = "/sys/%s/%s/thing/service/{}" % (self.__product_key, self.__device_name)
-        self.ica_topic_service_pub_reply = "/sys/%s/%s/thing/service/{}_reply" % (self.__product_key, self.__device_name)
+        self.ica_topic_property_post = sys_prefix + "thing/event/property/post"
+        self.ica_topic_property_post_reply = sys_prefix + "thing/event/property/post_reply"
+        self.ica_topic_property_set = sys_prefix + "thing/service/property/set"
+        self.ica_topic_property_set_reply = sys_prefix + "thing/service/property/set_reply"
+        self.ica_topic_event_post = sys_prefix + "thing/event/{}/post"
+        self.ica_topic_event_post_reply = sys_prefix + "thing/event/{}/post_reply"
+        self.ica_topic_service_sub = sys_prefix + "thing/service/{}"
+        self.ica_topic_service_pub_reply = sys_prefix + "thing/service/{}_reply"
         # OTA topic
-        self.ota_topic_device_inform = "/ota/device/inform/%s/%s" % (self.__product_key, self.__device_name)
-        self.ota_topic_device_upgrade = "/ota/device/upgrade/%s/%s" % (self.__product_key, self.__device_name)
-        self.ota_topic_device_progress = "/ota/device/progress/%s/%s" % (self.__product_key, self.__device_name)
-        self.ota_topic_firmware_get = "/sys/%s/%s/thing/ota/firmware/get" % (self.__product_key, self.__device_name)
-        self.ota_topic_firmware_get_reply = "/sys/%s/%s/thing/ota/firmware/get_reply" % (self.__product_key, self.__device_name)
+        self.ota_topic_device_inform = "/ota/device/inform" + ota_suffix
+        self.ota_topic_device_upgrade = "/ota/device/upgrade" + ota_suffix
+        self.ota_topic_device_progress = "/ota/device/progress" + ota_suffix
+        self.ota_topic_firmware_get = sys_prefix + "thing/ota/firmware/get"
+        self.ota_topic_firmware_get_reply = sys_prefix + "thing/ota/firmware/get_reply"
         # RRPC topic
-        self.rrpc_topic_request = "/sys/%s/%s/rrpc/request/+" % (self.__product_key, self.__device_name)
-        self.rrpc_topic_response = "/sys/%s/%s/rrpc/response/{}" % (self.__product_key, self.__device_name)
+        self.rrpc_topic_request = sys_prefix + "rrpc/request/+"
+        self.rrpc_topic_response = sys_prefix + "rrpc/response/{}"
+        # Formatted event and service topics, (post topic, post reply topic) and (subscribe topic, reply topic).
+        self.__event_topics = {event: self.__format_event_topics(event) for event in self.__events}
+        self.__service_topics = {service: self.__format_service_topics(service) for service in self.__services}
+        # Reply topics acknowledge a waiting publish, value is whether the message is also passed to callback.
+        self.__reply_topics = {topics[1]: False for topics in self.__event_topics.values()}
+        self.__reply_topics[self.ica_topic_property_post_reply] = False
+        self.__reply_topics[self.ota_topic_firmware_get_reply] = True
+
+    def __format_event_topics(self, event):
+        return (self.ica_topic_event_post.format(event), self.ica_topic_event_post_reply.format(event))
+
+    def __format_service_topics(self, service):
+        return (self.ica_topic_service_sub.format(service), self.ica_topic_service_pub_reply.format(service))
+
+    def __get_event_topics(self, event):
+        topics = self.__event_topics.get(event)
+        if topics is None:
+            topics = self.__format_event_topics(event)
+            self.__event_topics[event] = topics
+        return topics
+
+    def __get_service_topics(self, service):
+        topics = self.__service_topics.get(service)
+        if topics is None:
+            topics = self.__format_service_topics(service)
+            self.__service_topics[service] = topics
+        return topics
 
     def __subscribe_callback(self, topic, data):
         topic = topic.decode()
         try:
-            data = ujson.loads(data)
+            data = _json_loads(data)
         except:
             pass
         log.debug("topic: %s, data: %s" % (topic, str(data)))
 
-        if topic.endswith("/post_reply"):
-            self.__put_post_res(data["id"], True if int(data["code"]) == 200 else False)
-            return
-        elif topic.endswith("/thing/ota/firmware/get_reply"):
-            self.__put_post_res(data["id"], True if int(data["code"]) == 200 else False)
+        forward = self.__reply_topics.get(topic)
+        if forward is not None:
+            self.__put_post_res(data["id"], int(data["code"]) == 200)
+            if not forward:
+                return
 
         if self.__callback and callable(self.__callback):
             self.__callback((topic, data))
@@ -150,7 +210,7 @@ class AliYunIot:
     def __subscribe_topic(self, topic):
         subscribe_res = self.__cloud.subscribe(topic, qos=self.__qos) if self.__cloud else -1
         log.debug("subscribe_topic %s %s" % (topic, "success" if subscribe_res == 0 else "falied"))
-        return True if subscribe_res == 0 else False
+        return subscribe_res == 0
 
     def __subscribe_topics(self):
         self.__init_topics()
@@ -167,7 +227,7 @@ class AliYunIot:
             res = 5
         _res = 5
         for event in self.__events:
-            if not self.__subscribe_topic(self.ica_topic_event_post_reply.format(event)):
+            if not self.__subscribe_topic(self.__event_topics[event][1]):
                 _res += 1
                 break
         if _res != 5:
@@ -175,7 +235,7 @@ class AliYunIot:
             return res
         _res = 5 + len(self.__events)
         for service in self.__services:
-            if not self.__subscribe_topic(self.ica_topic_service_sub.format(service)):
+            if not self.__subscribe_topic(self.__service_topics[service][0]):
                 _res += 1
                 break
         if _res > 5 + len(self.__events):
@@ -187,7 +247,7 @@ class AliYunIot:
         try:
             _status = self.__cloud.getAliyunSta() if self.__cloud else -1
             log.debug("getAliyunSta: %s" % _status)
-            return True if _status == 0 else False
+            return _status == 0
         except Exception as e:
             sys.print_exception(e)
             log.error(str(e))
@@ -253,14 +313,16 @@ class AliYunIot:
         properties = {
             "id": _id,
             "version": "1.0",
-            "sys": {
-                "ack": 1
-            },
+            "sys": _SYS_ACK,
             "params": params,
             "method": "thing.event.property.post",
         }
-        pub_res = self.__cloud.publish(self.ica_topic_property_post, ujson.dumps(properties), qos=self.__qos) if self.__cloud else -1
-        return self.__get_post_res(_id) if pub_res is True else False
+        waiter = self.__init_post_res(_id)
+        pub_res = self.__cloud.publish(self.ica_topic_property_post, _json_dumps(properties), qos=self.__qos) if self.__cloud else -1
+        if pub_res is True:
+            return self.__get_post_res(_id, waiter)
+        self.__post_res.pop(_id, None)
+        return False
 
     def event_report(self, event, data):
         _timestamp = self.__timestamp
@@ -269,14 +331,16 @@ class AliYunIot:
         properties = {
             "id": _id,
             "version": "1.0",
-            "sys": {
-                "ack": 1
-            },
+            "sys": _SYS_ACK,
             "params": params,
             "method": "thing.event.%s.post" % event,
         }
-        pub_res = self.__cloud.publish(self.ica_topic_event_post.format(event), ujson.dumps(properties), qos=self.__qos) if self.__cloud else -1
-        return self.__get_post_res(_id) if pub_res is True else False
+        waiter = self.__init_post_res(_id)
+        pub_res = self.__cloud.publish(self.__get_event_topics(event)[0], _json_dumps(properties), qos=self.__qos) if self.__cloud else -1
+        if pub_res is True:
+            return self.__get_post_res(_id, waiter)
+        self.__post_res.pop(_id, None)
+        return False
 
     def service_response(self, service, code, data, msg_id, message):
         pub_data = {
@@ -286,7 +350,7 @@ class AliYunIot:
             "message": message,
             "version": "1.0",
         }
-        return self.__cloud.publish(self.ica_topic_service_pub_reply.format(service), ujson.dumps(pub_data), qos=self.__qos) if self.__cloud else False
+        return self.__cloud.publish(self.__get_service_topics(service)[1], _json_dumps(pub_data), qos=self.__qos) if self.__cloud else False
 
     def rrpc_response(self, msg_id, data):
         """Publish rrpc response
@@ -299,7 +363,7 @@ class AliYunIot:
             Ture: Success
             False: Failed
         """
-        pub_data = ujson.dumps(data) if isinstance(data, dict) else data
+        pub_data = data if isinstance(data, (str, bytes, bytearray)) else _json_dumps(data)
         return self.__cloud.publish(self.rrpc_topic_response.format(msg_id), pub_data, qos=self.__qos) if self.__cloud else False
 
     def property_set_reply(self, msg_id, code, msg):
@@ -310,44 +374,26 @@ class AliYunIot:
             "message": msg,
             "version": "1.0"
         }
-        return self.__cloud.publish(self.ica_topic_property_set_reply, ujson.dumps(data), qos=self.__qos) if self.__cloud else False
+        return self.__cloud.publish(self.ica_topic_property_set_reply, _json_dumps(data), qos=self.__qos) if self.__cloud else False
 
     def ota_device_inform(self, version, module):
-        _id = self.__id
-        publish_data = {
-            "id": _id,
-            "params": {
-                "version": version,
-                "module": module
-            }
-        }
-        return self.__cloud.publish(self.ota_topic_device_inform, ujson.dumps(publish_data), qos=self.__qos) if self.__cloud else False
+        publish_data = _OTA_DEVICE_INFORM_TMPL % (self.__id, _json_dumps(version), _json_dumps(module))
+        return self.__cloud.publish(self.ota_topic_device_inform, publish_data, qos=self.__qos) if self.__cloud else False
 
     def ota_firmware_get(self, module):
         _id = self.__id
-        publish_data = {
-            "id": _id,
-            "version": "1.0",
-            "params": {
-                "module": module,
-            },
-            "method": "thing.ota.firmware.get"
-        }
-        publish_res = self.__cloud.publish(self.ota_topic_firmware_get, ujson.dumps(publish_data), qos=self.__qos) if self.__cloud else False
+        publish_data = _OTA_FIRMWARE_GET_TMPL % (_id, _json_dumps(module))
+        waiter = self.__init_post_res(_id)
+        publish_res = self.__cloud.publish(self.ota_topic_firmware_get, publish_data, qos=self.__qos) if self.__cloud else False
         log.debug("module: %s, publish_res: %s" % (module, publish_res))
-        return self.__get_post_res(_id) if publish_res else False
+        if publish_res:
+            return self.__get_post_res(_id, waiter)
+        self.__post_res.pop(_id, None)
+        return False
 
     def ota_device_progress(self, step, desc, module):
-        _id = self.__id
-        publish_data = {
-            "id": _id,
-            "params": {
-                "step": step,
-                "desc": desc,
-                "module": module,
-            }
-        }
-        return self.__cloud.publish(self.ota_topic_device_progress, ujson.dumps(publish_data), qos=self.__qos) if self.__cloud else False
+        publish_data = _OTA_DEVICE_PROGRESS_TMPL % (self.__id, _json_dumps(step), _json_dumps(desc), _json_dumps(module))
+        return self.__cloud.publish(self.ota_topic_device_progress, publish_data, qos=self.__qos) if self.__cloud else False
 
 
 class AliYunOTA:
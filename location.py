@@ -21,7 +21,6 @@
 @copyright :Copyright (c) 2022
 """
 
-import ure
 import math
 import utime
 import osTimer
@@ -47,6 +46,75 @@ _gps_data_set_lock = _thread.allocate_lock()
 
 CRLF = "\r\n"
 
+# Max size of gps data kept while reading, older statements beyond it are dropped.
+_GPS_DATA_MAX_SIZE = 4096
+
+# NMEA statement type and the talker ids accepted for it.
+_NMEA_TALKERS = {
+    "RMC": ("GN", "GP"),
+    "GGA": ("GB", "GL", "GP", "GN"),
+    "GSV": ("GN", "GP"),
+    "GSA": ("GN", "GP"),
+    "VTG": ("GN", "GP"),
+    "GLL": ("GN", "GP"),
+}
+
+# Mandatory fields of NMEA statement, (field index, accepted values), statement without them is not used.
+_NMEA_REQUIRED = {
+    "RMC": ((2, "AV"), (4, "NS"), (6, "EW")),
+    "GGA": ((3, "NS"), (5, "EW"), (6, "0126"), (10, "M"), (12, "M")),
+    "VTG": ((2, "T"), (4, "M"), (6, "N"), (8, "K")),
+}
+
+
+def _nmea_fields(nmea):
+    return tuple(nmea[1:].split("*")[0].split(",")) if nmea else ()
+
+
+def _nmea_checksum_valid(nmea):
+    """Check statement "$...*hh", hh is the XOR of all characters between "$" and "*"."""
+    try:
+        checksum = int(nmea[-2:], 16)
+    except ValueError:
+        return False
+    for c in nmea[1:-3]:
+        checksum ^= ord(c)
+    return checksum == 0
+
+
+def _nmea_required_valid(nmea):
+    required = _NMEA_REQUIRED.get(nmea[3:6])
+    if required:
+        fields = nmea[:-3].split(",")
+        for index, values in required:
+            if index >= len(fields) or len(fields[index]) != 1 or fields[index] not in values:
+                return False
+    return True
+
+
+def _nmea_statements(gps_data):
+    """Scan gps data once, return the first complete and verified statement of each type.
+
+    Statements missing mandatory fields, e.g. GGA or RMC without position, are skipped.
+    """
+    statements = {}
+    start = gps_data.find("$")
+    while start >= 0:
+        end = gps_data.find("*", start)
+        if end < 0:
+            break
+        _next = gps_data.find("$", start + 1, end)
+        if _next >= 0:
+            # Statement is truncated by the next one.
+            start = _next
+            continue
+        nmea = gps_data[start:end + 3]
+        if len(nmea) == end + 3 - start and nmea[3:6] not in statements and \
+                nmea[1:3] in _NMEA_TALKERS.get(nmea[3:6], ()) and _nmea_required_valid(nmea) and _nmea_checksum_valid(nmea):
+            statements[nmea[3:6]] = nmea
+        start = gps_data.find("$", end)
+    return statements
+
 
 class CoordinateSystemConvert:
 
@@ -88,70 +156,50 @@ class NMEAParse:
 
     def __init__(self):
         self.__gps_data = ""
-
-    def __parse(self, nmea):
-        return tuple(nmea[1:].split("*")[0].split(",")) if nmea else ()
+        self.__statements = None
+        self.__statements_data = {}
+
+    def __statement(self, name):
+        if self.__statements is None:
+            self.__statements = _nmea_statements(self.__gps_data) if self.__gps_data else {}
+        return self.__statements.get(name, "")
+
+    def __statement_data(self, name):
+        # Statement fields are parsed once, Latitude, Longitude and Altitude share the GGA fields.
+        data = self.__statements_data.get(name)
+        if data is None:
+            data = _nmea_fields(self.__statement(name))
+            self.__statements_data[name] = data
+        return data
 
     def set_gps_data(self, gps_data):
         self.__gps_data = gps_data
+        self.__statements = None
+        self.__statements_data = {}
 
     @property
     def GxRMC(self):
-        if self.__gps_data:
-            rmc_re = ure.search(
-                r"\$G[NP]RMC,\d*\.*\d*,*[AV],*\d*\.*\d*,*[NS],*\d*\.*\d*,*[EW],*\d*\.*\d*,*\d*\.*\d*,*\d*,*\d*\.*\d*,*[EW]*,*[ADEN]*,*[SCUV]*\**(\d|\w)*",
-                self.__gps_data)
-            if rmc_re:
-                return rmc_re.group(0)
-        return ""
+        return self.__statement("RMC")
 
     @property
     def GxGGA(self):
-        if self.__gps_data:
-            gga_re = ure.search(
-                r"\$G[BLPN]GGA,\d*\.*\d*,*\d*\.*\d*,*[NS],*\d*\.*\d*,*[EW],*[0126],*\d*,*\d*\.*\d*,*-*\d*\.*\d*,*M,*-*\d*\.*\d*,*M,*\d*,*\**(\d|\w)*",
-                self.__gps_data)
-            if gga_re:
-                return gga_re.group(0)
-        return ""
+        return self.__statement("GGA")
 
     @property
     def GxVTG(self):
-        if self.__gps_data:
-            vtg_re = ure.search(
-                r"\$G[NP]VTG,\d*\.*\d*,*T,*\d*\.*\d*,*M,*\d*\.*\d*,*N,*\d*\.*\d*,*K,*[ADEN]*\*(\d|\w)*",
-                self.__gps_data)
-            if vtg_re:
-                return vtg_re.group(0)
-        return ""
+        return self.__statement("VTG")
 
     @property
     def GxGSV(self):
-        if self.__gps_data:
-            gsv_re = ure.search(
-                r"\$G[NP]GSV,\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*\**(\d|\w)*",
-                self.__gps_data)
-            if gsv_re:
-                return gsv_re.group(0)
-        return ""
+        return self.__statement("GSV")
 
     @property
     def GxGLL(self):
-        if self.__gps_data:
-            gll_re = ure.search(
-                r"\$G[NP]GLL,\d*\.*\d*,*[NS]*,*\d*\.*\d*,*[EW]*,*\d*\.*\d*,*[AV]*,*[ADEN]*\**(\d|\w)*",
-                self.__gps_data)
-            if gll_re:
-                return gll_re.group(0)
+        return self.__statement("GLL")
 
     @property
     def GxGSA(self):
-        if self.__gps_data:
-            gsa_re = ure.search(
-                r"\$G[NP]GSA,[MA]*,*[123]*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*\.*\d*,*\d*\.*\d*,*\d*\.*\d*,*(\d|\w)*\**(\d|\w)*",
-                self.__gps_data)
-            if gsa_re:
-                return gsa_re.group(0)
+        return self.__statement("GSA")
 
     @property
     def GxRMCData(self):
@@ -163,27 +211,27 @@ class NMEAParse:
                 ground rate, ground heading, UTC date, magnetic declination, Magnetic declination direction, Mode indication
             )
         """
-        return self.__parse(self.GxRMC)
+        return self.__statement_data("RMC")
 
     @property
     def GxGGAData(self):
-        return self.__parse(self.GxGGA)
+        return self.__statement_data("GGA")
 
     @property
     def GxGSVData(self):
-        return self.__parse(self.GxGSV)
+        return self.__statement_data("GSV")
 
     @property
     def GxGSAData(self):
-        return self.__parse(self.GxGSA)
+        return self.__statement_data("GSA")
 
     @property
     def GxVTGData(self):
-        return self.__parse(self.GxVTG)
+        return self.__statement_data("VTG")
 
     @property
     def GxGLLData(self):
-        return self.__parse(self.GxGLL)
+        return self.__statement_data("GLL")
 
     @property
     def Latitude(self):
@@ -291,23 +339,27 @@ class GNSS(GNSSPower):
         self.__flowctl = flowctl
         self.__gps_mode = gps_mode
         self.__NMEA = nmea if nmea else 0b010111
+        # Statements required besides RMC.
+        self.__nmea_items = tuple(
+            name for name, item in (("GGA", self.__GGA), ("GSV", self.__GSV), ("GSA", self.__GSA), ("VTG", self.__VTG), ("GLL", self.__GLL))
+            if self.__nmea_statement_exist(item)
+        )
 
         self.__external_obj = None
         self.__internal_obj = quecgnss
-        self.__nmea_parse = NMEAParse()
 
-        self.__external_retrieve_queue = None
-        self.__queue_size = 2
+        self.__external_retrieve_lock = None
         self.__first_break = 0
         self.__break = 0
-        self.__gps_data = ""
-        self.__rmc_data = ""
-        self.__gga_data = ""
-        self.__vtg_data = ""
-        self.__gsv_data = ""
+        self.__retrieved = 0
+        self.__gps_data = []
+        self.__new_gps_data = ""
+        self.__rmc_info = ()
+        self.__nmea_data = {}
 
-        self.__gps_timer = osTimer()
-        self.__gps_data_check_timer = osTimer()
+        # Timers are created on first read, osTimer is a limited system resource.
+        self.__gps_timer = None
+        self.__gps_data_check_timer = None
 
         if self.__gps_mode == self._gps_mode.external:
             self.__external_init()
@@ -316,33 +368,75 @@ class GNSS(GNSSPower):
 
     @option_lock(_gps_data_set_lock)
     def __set_gps_data(self, gps_data):
-        self.__gps_data = gps_data
+        self.__gps_data = [gps_data] if gps_data else []
 
     @option_lock(_gps_data_set_lock)
     def __get_gps_data(self):
-        return self.__gps_data
+        return "".join(self.__gps_data)
+
+    @option_lock(_gps_data_set_lock)
+    def __pop_gps_data_head(self):
+        """Pop the newest statement of gps data, it may be incomplete."""
+        if not self.__gps_data:
+            return ""
+        segment = self.__gps_data[0]
+        head_end = segment.find(CRLF)
+        if head_end < 0:
+            self.__gps_data.pop(0)
+            return segment
+        self.__gps_data[0] = segment[head_end:]
+        return segment[:head_end]
+
+    @option_lock(_gps_data_set_lock)
+    def __push_gps_data(self, gps_data):
+        self.__gps_data.insert(0, gps_data)
+        size = 0
+        for i, segment in enumerate(self.__gps_data):
+            size += len(segment)
+            if size >= _GPS_DATA_MAX_SIZE:
+                del self.__gps_data[i + 1:]
+                break
+
+    @option_lock(_gps_data_set_lock)
+    def __add_new_gps_data(self, gps_data):
+        self.__new_gps_data = gps_data + CRLF + self.__new_gps_data if self.__new_gps_data else gps_data
+
+    @option_lock(_gps_data_set_lock)
+    def __pop_new_gps_data(self):
+        """Pop gps data received since last check, newest statement first."""
+        new_gps_data = self.__new_gps_data
+        self.__new_gps_data = ""
+        return new_gps_data
 
     def __reverse_gps_data(self, this_gps_data):
         log.debug("this_gps_data: \n%s" % this_gps_data)
         if this_gps_data:
-            _gps_data = self.__get_gps_data()
-            if _gps_data:
-                _gps_data = CRLF.join(_gps_data.split(CRLF)[::-1])
-            _gps_data += this_gps_data.strip().replace("\r", "").replace("\n", "").replace("$", CRLF + "$")
-            _gps_data = CRLF.join(_gps_data.split(CRLF)[::-1])
-            self.__set_gps_data(_gps_data)
+            # Gps data is saved as segments newest statement first, the head statement may be incomplete
+            # and continued by this data, so only the head and this data are split and reversed.
+            _new_gps_data = self.__pop_gps_data_head() + this_gps_data.strip().replace("\r", "").replace("\n", "").replace("$", CRLF + "$")
+            _new_gps_data = CRLF.join(_new_gps_data.split(CRLF)[::-1])
+            self.__add_new_gps_data(_new_gps_data)
+            self.__push_gps_data(_new_gps_data)
 
     def __gps_timer_callback(self, args):
         self.__break = 1
-        if self.__external_retrieve_queue is not None:
-            self.__external_retrieve_queue.put(False)
+        self.__external_retrieve_notify()
+
+    def __gps_watchdog_callback(self, args):
+        # Stop reading when no uart data retrieved in a whole period.
+        if self.__retrieved:
+            self.__retrieved = 0
+        else:
+            self.__gps_timer_callback(args)
 
     def __gps_data_check_callback(self, args):
         if not self.__check_gps_valid():
             self.__gps_nmea_data_clean()
 
     def __external_init(self):
-        self.__external_retrieve_queue = Queue(maxsize=self.__queue_size)
+        # Binary semaphore, released by uart callback or timeout, acquired by reader.
+        self.__external_retrieve_lock = _thread.allocate_lock()
+        self.__external_retrieve_lock.acquire()
 
     def __external_open(self):
         self.power_switch(1)
@@ -360,9 +454,16 @@ class GNSS(GNSSPower):
         self.__external_obj.close()
 
     def __external_retrieve_cb(self, args):
-        if self.__external_retrieve_queue.size() >= self.__queue_size:
-            self.__external_retrieve_queue.get()
-        self.__external_retrieve_queue.put(True)
+        self.__retrieved = 1
+        self.__external_retrieve_notify()
+
+    def __external_retrieve_notify(self):
+        if self.__external_retrieve_lock is not None:
+            try:
+                self.__external_retrieve_lock.release()
+            except RuntimeError:
+                # Already released, reader has not taken the last notification yet.
+                pass
 
     def __internal_init(self):
         if self.__internal_obj:
@@ -384,70 +485,63 @@ class GNSS(GNSSPower):
 
     def __gps_nmea_data_clean(self):
         self.__set_gps_data("")
-        self.__rmc_data = ""
-        self.__gga_data = ""
-        self.__gsv_data = ""
-        self.__gsa_data = ""
-        self.__vtg_data = ""
-        self.__gll_data = ""
+        self.__pop_new_gps_data()
+        self.__rmc_info = ()
+        self.__nmea_data = {}
 
     def __check_gps_valid(self):
-        self.__nmea_parse.set_gps_data(self.__get_gps_data())
-        if not self.__rmc_data:
-            self.__rmc_data = self.__nmea_parse.GxRMC
-        _rmc_info = self.__nmea_parse.GxRMCData
-        loc_status = _rmc_info[2] if _rmc_info else "V"
-
-        if self.__rmc_data and loc_status == "A":
-            if self.__nmea_statement_exist(self.__GGA) and not self.__gga_data:
-                self.__gga_data = self.__nmea_parse.GxGGA
-            if self.__nmea_statement_exist(self.__GSV) and not self.__gsv_data:
-                self.__gsv_data = self.__nmea_parse.GxGSV
-            if self.__nmea_statement_exist(self.__GSA) and not self.__gsa_data:
-                self.__gsa_data = self.__nmea_parse.GxGSA
-            if self.__nmea_statement_exist(self.__VTG) and not self.__vtg_data:
-                self.__vtg_data = self.__nmea_parse.GxVTG
-            if self.__nmea_statement_exist(self.__GLL) and not self.__gll_data:
-                self.__gll_data = self.__nmea_parse.GxGLL
-
-            if self.__nmea_statement_exist(self.__GGA) and not self.__gga_data:
-                return False
-            if self.__nmea_statement_exist(self.__GSV) and not self.__gsv_data:
-                return False
-            if self.__nmea_statement_exist(self.__GSA) and not self.__gsa_data:
-                return False
-            if self.__nmea_statement_exist(self.__VTG) and not self.__vtg_data:
-                return False
-            if self.__nmea_statement_exist(self.__GLL) and not self.__gll_data:
-                return False
+        # Only statements received since last check are parsed, earlier ones have been checked.
+        new_gps_data = self.__pop_new_gps_data()
+        statements = _nmea_statements(new_gps_data) if new_gps_data else {}
+        if "RMC" in statements:
+            self.__nmea_data.setdefault("RMC", statements["RMC"])
+            self.__rmc_info = _nmea_fields(statements["RMC"])
+        loc_status = self.__rmc_info[2] if self.__rmc_info else "V"
+
+        fixed = "RMC" in self.__nmea_data and loc_status == "A"
+        # Keep the newest statements until located, they may come before the located RMC.
+        for name in self.__nmea_items:
+            if name in statements and (not fixed or name not in self.__nmea_data):
+                self.__nmea_data[name] = statements[name]
+
+        if fixed:
+            for name in self.__nmea_items:
+                if name not in self.__nmea_data:
+                    return False
             return True
 
         return False
 
     def __external_read(self):
+        if self.__gps_timer is None:
+            self.__gps_timer = osTimer()
+        if self.__gps_data_check_timer is None:
+            self.__gps_data_check_timer = osTimer()
         self.__external_open()
         log.debug("__external_read start")
 
         while self.__break == 0:
             self.__gps_timer.start(50, 0, self.__gps_timer_callback)
-            signal = self.__external_retrieve_queue.get()
-            log.debug("[first] signal: %s" % signal)
-            if signal:
+            self.__external_retrieve_lock.acquire()
+            log.debug("[first] break: %s" % self.__break)
+            if self.__break == 0:
                 to_read = self.__external_obj.any()
                 log.debug("[first] to_read: %s" % to_read)
                 if to_read > 0:
-                    self.__set_gps_data(self.__external_obj.read(to_read).decode())
+                    # Drop data retrieved before the first output gap, it may start in the middle of a statement.
+                    self.__external_obj.read(to_read)
             self.__gps_timer.stop()
         self.__break = 0
 
         self.__gps_nmea_data_clean()
         self.__gps_data_check_timer.start(2000, 1, self.__gps_data_check_callback)
         cycle = 0
+        self.__retrieved = 0
+        self.__gps_timer.start(1500, 1, self.__gps_watchdog_callback)
         while self.__break == 0:
-            self.__gps_timer.start(1500, 0, self.__gps_timer_callback)
-            signal = self.__external_retrieve_queue.get()
-            log.debug("[second] signal: %s" % signal)
-            if signal:
+            self.__external_retrieve_lock.acquire()
+            log.debug("[second] break: %s" % self.__break)
+            if self.__break == 0:
                 to_read = self.__external_obj.any()
                 log.debug("[second] to_read: %s" % to_read)
                 if to_read > 0:
@@ -455,12 +549,12 @@ class GNSS(GNSSPower):
                     if self.__check_gps_valid():
                         self.__break = 1
 
-            self.__gps_timer.stop()
             cycle += 1
             if cycle >= self.__retry:
                 self.__break = 1
             if self.__break != 1:
                 utime.sleep(1)
+        self.__gps_timer.stop()
         self.__gps_data_check_timer.stop()
         self.__break = 0
 
@@ -472,6 +566,8 @@ class GNSS(GNSSPower):
 
     def __internal_read(self):
         log.debug("__internal_read start.")
+        if self.__gps_data_check_timer is None:
+            self.__gps_data_check_timer = osTimer()
         self.__internal_open()
 
         while self.__break == 0:
@@ -485,9 +581,8 @@ class GNSS(GNSSPower):
         cycle = 0
         while self.__break == 0:
             gnss_data = quecgnss.read(1024)
-            if gnss_data and gnss_data[1]:
-                this_gps_data = gnss_data[1].decode() if len(gnss_data) > 1 and gnss_data[1] else ""
-                self.__reverse_gps_data(this_gps_data)
+            if gnss_data and len(gnss_data) > 1 and gnss_data[1]:
+                self.__reverse_gps_data(gnss_data[1].decode())
                 if self.__check_gps_valid():
                     self.__break = 1
             cycle += 1
@@ -520,11 +615,7 @@ class CellLocator:
     """This class is for reading cell location data"""
 
     def __init__(self, serverAddr, port, token, timeout, profileIdx):
-        self.__serverAddr = serverAddr
-        self.__port = port
-        self.__token = token
-        self.__timeout = timeout
-        self.__profileIdx = profileIdx
+        self.__args = (serverAddr, port, token, timeout, profileIdx)
         self.__queue = Queue()
         self.__thread_id = None
         self.__timeout_timer = osTimer()
@@ -535,13 +626,7 @@ class CellLocator:
     def __read_thread(self):
         loc_data = ()
         try:
-            loc_data = cellLocator.getLocation(
-                self.__serverAddr,
-                self.__port,
-                self.__token,
-                self.__timeout,
-                self.__profileIdx
-            )
+            loc_data = cellLocator.getLocation(*self.__args)
             loc_data = loc_data if isinstance(loc_data, tuple) and loc_data[0] and loc_data[1] else ()
         except Exception as e:
             sys.print_exception(e)